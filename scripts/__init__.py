@@ -0,0 +1 @@
+"""Scripts del pipeline de análisis para la empresa de aceros largos"""
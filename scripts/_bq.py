@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+Cliente BigQuery compartido entre los scripts del pipeline de aceros
+Evita inicializar credenciales y conexiones más de una vez por proceso
+"""
+
+from google.cloud import bigquery
+
+_client = None
+
+def get_client(project_id):
+    """Obtener el cliente BigQuery del proceso (se crea en la primera llamada)"""
+    global _client
+    _client = _client or bigquery.Client(project=project_id)
+    return _client
@@ -6,10 +6,14 @@ Monitorea la integridad y consistencia de los datos procesados
 
 import os
 import logging
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
-from datetime import datetime, timedelta
-import json
+try:
+    from ._bq import get_client
+except ImportError:  # Ejecutado directamente como script
+    from _bq import get_client
+from datetime import datetime, timedelta, timezone
+import orjson
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +22,20 @@ logger = logging.getLogger(__name__)
 # Configuración
 PROJECT_ID = os.getenv('PROJECT_ID') or 'your-project-id'
 DATASET_NAME = 'acero_analysis'
+TABLE_NAME = 'cdo_challenge'
+DAILY_STATS_VIEW = 'mv_daily_stats'  # Creada por load_data.py
+# Presupuesto máximo de bytes a escanear por verificación (estimado con dry-run)
+DEFAULT_BUDGET_BYTES = 10 * 1024**3
+_budget_bytes = os.getenv('QUERY_BUDGET_BYTES') or ''
+if _budget_bytes.isdigit() and int(_budget_bytes) > 0:
+    BUDGET_BYTES = int(_budget_bytes)
+else:
+    if _budget_bytes:
+        logger.warning(f"⚠️  QUERY_BUDGET_BYTES inválido ({_budget_bytes!r}), se usará el valor por defecto")
+    BUDGET_BYTES = DEFAULT_BUDGET_BYTES
+
+# Resultado de una verificación omitida por superar el presupuesto (ni aprobada ni fallida)
+CHECK_SKIPPED = 'skipped'
 
 class DataQualityChecker:
     """Clase para verificar calidad de datos"""
@@ -25,33 +43,55 @@ class DataQualityChecker:
     def __init__(self):
         """Inicializar cliente BigQuery"""
         try:
-            self.client = bigquery.Client(project=PROJECT_ID)
+            self.client = get_client(PROJECT_ID)
+            # Consultas deterministas: reutilizan la caché de resultados de BigQuery (24 h)
+            self.cached_job_config = bigquery.QueryJobConfig(use_query_cache=True)
             logger.info(f"✅ Cliente BigQuery inicializado para proyecto: {PROJECT_ID}")
         except Exception as e:
             logger.error(f"❌ Error inicializando BigQuery: {e}")
             raise
     
+    def _estimate(self, sql):
+        """Estimar bytes a procesar por una consulta sin ejecutarla (dry-run)"""
+        cfg = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        job = self.client.query(sql, job_config=cfg)
+        return job.total_bytes_processed
+    
+    def _within_budget(self, sql):
+        """Verificar que la consulta no supere el presupuesto de bytes"""
+        estimated_bytes = self._estimate(sql)
+        if estimated_bytes > BUDGET_BYTES:
+            # Las verificaciones leen la vista materializada: un escaneo grande indica
+            # que se perdió la poda de particiones o la vista tras un cambio de esquema
+            logger.warning(
+                f"⚠️  Consulta omitida: escanearía {estimated_bytes / (1024**3):.2f} GB "
+                f"(presupuesto: {BUDGET_BYTES / (1024**3):.2f} GB)"
+            )
+            return False
+        return True
+    
     def check_data_freshness(self):
         """Verificar frescura de los datos"""
         logger.info("🔍 Verificando frescura de los datos...")
         
         query = f"""
         SELECT 
-            MAX(_PARTITIONTIME) as latest_partition,
-            CURRENT_TIMESTAMP() as current_time,
-            TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), MAX(_PARTITIONTIME), HOUR) as hours_since_update
-        FROM `{PROJECT_ID}.{DATASET_NAME}.cdo_challenge`
-        WHERE _PARTITIONTIME IS NOT NULL
+            MAX(latest) as latest_partition
+        FROM `{PROJECT_ID}.{DATASET_NAME}.{DAILY_STATS_VIEW}`
+        WHERE d IS NOT NULL
         """
         
         try:
-            query_job = self.client.query(query)
+            if not self._within_budget(query):
+                return CHECK_SKIPPED
+            
+            query_job = self.client.query(query, job_config=self.cached_job_config)
             results = query_job.result()
             
             for row in results:
                 latest_update = row.latest_partition
-                hours_since = row.hours_since_update
-                current_time = row.current_time
+                # Se calcula en el cliente: CURRENT_TIMESTAMP() en el SQL invalida la caché
+                hours_since = (datetime.now(timezone.utc) - latest_update).total_seconds() / 3600
                 
                 logger.info(f"📅 Última actualización: {latest_update}")
                 logger.info(f"⏰ Hace {hours_since:.1f} horas")
@@ -72,37 +112,37 @@ class DataQualityChecker:
         """Verificar completitud de los datos"""
         logger.info("🔍 Verificando completitud de los datos...")
         
+        # Timestamps desde la vista: el grupo d IS NULL cuenta las filas sin partición
         query = f"""
         SELECT 
-            COUNT(*) as total_records,
-            COUNTIF(_PARTITIONTIME IS NOT NULL) as valid_timestamps,
-            COUNTIF(_FILE_NAME IS NOT NULL) as valid_filenames,
-            COUNTIF(_FILE_LOAD_TIME IS NOT NULL) as valid_loadtimes
-        FROM `{PROJECT_ID}.{DATASET_NAME}.cdo_challenge`
+            SUM(n) as total_records,
+            SUM(IF(d IS NOT NULL, n, 0)) as valid_timestamps
+        FROM `{PROJECT_ID}.{DATASET_NAME}.{DAILY_STATS_VIEW}`
         """
         
         try:
-            query_job = self.client.query(query)
+            if not self._within_budget(query):
+                return CHECK_SKIPPED
+            
+            query_job = self.client.query(query, job_config=self.cached_job_config)
             results = query_job.result()
             
             for row in results:
                 total = row.total_records
                 valid_timestamps = row.valid_timestamps
-                valid_filenames = row.valid_filenames
-                valid_loadtimes = row.valid_loadtimes
                 
                 # Calcular porcentajes de completitud
                 timestamp_completeness = (valid_timestamps / total) * 100
-                filename_completeness = (valid_filenames / total) * 100
-                loadtime_completeness = (valid_loadtimes / total) * 100
+                filename_completeness, loadtime_completeness = self._file_completeness()
                 
                 logger.info(f"📊 Completitud de datos:")
                 logger.info(f"   - Timestamps: {timestamp_completeness:.2f}%")
-                logger.info(f"   - Nombres de archivo: {filename_completeness:.2f}%")
-                logger.info(f"   - Tiempos de carga: {loadtime_completeness:.2f}%")
+                if filename_completeness is not None:
+                    logger.info(f"   - Nombres de archivo: {filename_completeness:.2f}%")
+                    logger.info(f"   - Tiempos de carga: {loadtime_completeness:.2f}%")
                 
                 # Verificar si la completitud es aceptable (>95%)
-                if timestamp_completeness > 95 and filename_completeness > 95:
+                if timestamp_completeness > 95 and (filename_completeness is None or filename_completeness > 95):
                     logger.info("✅ Completitud de datos aceptable")
                     return True
                 else:
@@ -113,35 +153,71 @@ class DataQualityChecker:
             logger.error(f"❌ Error verificando completitud: {e}")
             return False
     
+    def _file_completeness(self):
+        """Completitud de las pseudo-columnas de archivo, o (None, None) si no están disponibles"""
+        # _FILE_NAME y _FILE_LOAD_TIME solo existen en tablas externas; en la tabla
+        # nativa cargada por load_data.py la consulta falla y se omite esta parte
+        query = f"""
+        SELECT 
+            COUNT(*) as total_records,
+            COUNTIF(_FILE_NAME IS NOT NULL) as valid_filenames,
+            COUNTIF(_FILE_LOAD_TIME IS NOT NULL) as valid_loadtimes
+        FROM `{PROJECT_ID}.{DATASET_NAME}.{TABLE_NAME}`
+        """
+        
+        try:
+            if not self._within_budget(query):
+                return None, None
+            
+            row = next(iter(self.client.query(query, job_config=self.cached_job_config).result()))
+            return (
+                (row.valid_filenames / row.total_records) * 100,
+                (row.valid_loadtimes / row.total_records) * 100
+            )
+        except Exception as e:
+            logger.warning(f"⚠️  Pseudo-columnas de archivo no disponibles, se omiten: {e}")
+            return None, None
+    
     def check_data_consistency(self):
         """Verificar consistencia de los datos"""
         logger.info("🔍 Verificando consistencia de los datos...")
         
+        # Estadísticas de los últimos 30 días calculadas en BigQuery: se transporta una sola fila
         query = f"""
+        WITH daily AS (
+            SELECT d, n
+            FROM `{PROJECT_ID}.{DATASET_NAME}.{DAILY_STATS_VIEW}`
+            WHERE d IS NOT NULL
+            ORDER BY d DESC
+            LIMIT 30
+        )
         SELECT 
-            DATE(_PARTITIONTIME) as date,
-            COUNT(*) as daily_records,
-            COUNT(DISTINCT _FILE_NAME) as daily_files,
-            AVG(COUNT(*)) OVER (ORDER BY DATE(_PARTITIONTIME) ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as moving_avg_7d
-        FROM `{PROJECT_ID}.{DATASET_NAME}.cdo_challenge`
-        WHERE _PARTITIONTIME IS NOT NULL
-        GROUP BY DATE(_PARTITIONTIME)
-        ORDER BY date DESC
-        LIMIT 30
+            COUNT(*) as days,
+            AVG(n) as mean_n,
+            STDDEV(n) as std_n,
+            SAFE_DIVIDE(STDDEV(n), AVG(n)) * 100 as cv
+        FROM daily
         """
         
         try:
-            query_job = self.client.query(query)
-            df = query_job.to_dataframe()
+            if not self._within_budget(query):
+                return CHECK_SKIPPED
             
-            if len(df) == 0:
+            query_job = self.client.query(query, job_config=self.cached_job_config)
+            row = next(iter(query_job.result()))
+            
+            if row.days == 0:
                 logger.warning("⚠️  No hay datos para verificar consistencia")
                 return False
             
-            # Calcular estadísticas de consistencia
-            daily_records_std = df['daily_records'].std()
-            daily_records_mean = df['daily_records'].mean()
-            coefficient_variation = (daily_records_std / daily_records_mean) * 100
+            # STDDEV es NULL con un solo día (y el CV también si el promedio es 0)
+            if row.std_n is None or row.cv is None:
+                logger.warning("⚠️  Datos insuficientes para verificar consistencia")
+                return False
+            
+            daily_records_mean = row.mean_n
+            daily_records_std = row.std_n
+            coefficient_variation = row.cv
             
             logger.info(f"📈 Consistencia de datos:")
             logger.info(f"   - Promedio diario: {daily_records_mean:,.0f}")
@@ -170,26 +246,40 @@ class DataQualityChecker:
             'mart_business_insights'
         ]
         
-        results = {}
+        results = {model: 0 for model in models_to_check}
         
+        # Un modelo inexistente haría fallar todo el UNION ALL: se verifica antes con metadatos
+        existing_models = []
         for model in models_to_check:
             try:
-                query = f"""
-                SELECT COUNT(*) as record_count
-                FROM `{PROJECT_ID}.{DATASET_NAME}.{model}`
-                """
+                self.client.get_table(f"{PROJECT_ID}.{DATASET_NAME}.{model}")
+                existing_models.append(model)
+            except Exception as e:
+                logger.error(f"❌ Error verificando modelo {model}: {e}")
+        
+        if existing_models:
+            # Un solo job para todos los conteos (stg_cdo_challenge es una vista y no expone num_rows)
+            query = "\nUNION ALL\n".join(
+                f"SELECT '{model}' as model, COUNT(*) as record_count "
+                f"FROM `{PROJECT_ID}.{DATASET_NAME}.{model}`"
+                for model in existing_models
+            )
+            
+            try:
+                if not self._within_budget(query):
+                    return CHECK_SKIPPED
                 
-                query_job = self.client.query(query)
+                query_job = self.client.query(query, job_config=self.cached_job_config)
                 count_result = query_job.result()
                 
                 for row in count_result:
-                    record_count = row.record_count
-                    results[model] = record_count
-                    logger.info(f"   - {model}: {record_count:,} registros")
+                    results[row.model] = row.record_count
+                
+                for model in existing_models:
+                    logger.info(f"   - {model}: {results[model]:,} registros")
                     
             except Exception as e:
-                logger.error(f"❌ Error verificando modelo {model}: {e}")
-                results[model] = 0
+                logger.error(f"❌ Error contando registros de modelos dbt: {e}")
         
         # Verificar si todos los modelos tienen datos
         all_models_have_data = all(count > 0 for count in results.values())
@@ -201,6 +291,14 @@ class DataQualityChecker:
             logger.warning("⚠️  Algunos modelos dbt no tienen datos")
             return False
     
+    @staticmethod
+    def _run_check(check_function):
+        """Ejecutar una verificación y registrar el momento en que terminó"""
+        try:
+            return check_function(), None, datetime.now().isoformat()
+        except Exception as e:
+            return None, e, datetime.now().isoformat()
+    
     def generate_quality_report(self):
         """Generar reporte de calidad completo"""
         logger.info("📋 Generando reporte de calidad...")
@@ -220,30 +318,45 @@ class DataQualityChecker:
             ('dbt_models', self.check_dbt_models)
         ]
         
-        for check_name, check_function in checks:
-            try:
-                result = check_function()
+        # Las verificaciones son independientes y pasan casi todo el tiempo esperando a BigQuery
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = {
+                check_name: executor.submit(self._run_check, check_function)
+                for check_name, check_function in checks
+            }
+        
+        for check_name, future in futures.items():
+            result, error, finished_at = future.result()
+            if result is CHECK_SKIPPED:
+                report['checks'][check_name] = {
+                    'status': 'skipped',
+                    'timestamp': finished_at
+                }
+            elif error is None:
                 report['checks'][check_name] = {
                     'status': 'passed' if result else 'failed',
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': finished_at
                 }
-            except Exception as e:
+            else:
                 report['checks'][check_name] = {
                     'status': 'error',
-                    'error': str(e),
-                    'timestamp': datetime.now().isoformat()
+                    'error': str(error),
+                    'timestamp': finished_at
                 }
         
-        # Calcular score general
-        passed_checks = sum(1 for check in report['checks'].values() if check['status'] == 'passed')
-        total_checks = len(report['checks'])
-        quality_score = (passed_checks / total_checks) * 100
+        # Calcular score general (las verificaciones omitidas no cuentan)
+        evaluated_checks = [check for check in report['checks'].values() if check['status'] != 'skipped']
+        passed_checks = sum(1 for check in evaluated_checks if check['status'] == 'passed')
+        total_checks = len(evaluated_checks)
+        skipped_checks = len(report['checks']) - total_checks
+        quality_score = (passed_checks / total_checks) * 100 if total_checks > 0 else 0
         
         report['overall_score'] = quality_score
         report['summary'] = {
             'total_checks': total_checks,
             'passed_checks': passed_checks,
             'failed_checks': total_checks - passed_checks,
+            'skipped_checks': skipped_checks,
             'quality_score': f"{quality_score:.1f}%"
         }
         
@@ -251,8 +364,12 @@ class DataQualityChecker:
         os.makedirs('reports', exist_ok=True)
         report_filename = f"reports/data_quality_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
         
-        with open(report_filename, 'w', encoding='utf-8') as f:
-            json.dump(report, f, indent=2, default=str, ensure_ascii=False)
+        # orjson serializa datetime/numpy de forma nativa y siempre escribe UTF-8
+        with open(report_filename, 'wb') as f:
+            f.write(orjson.dumps(
+                report,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            ))
         
         logger.info(f"✅ Reporte de calidad guardado en: {report_filename}")
         
@@ -260,6 +377,8 @@ class DataQualityChecker:
         logger.info(f"📊 RESUMEN DE CALIDAD:")
         logger.info(f"   - Score general: {quality_score:.1f}%")
         logger.info(f"   - Verificaciones pasadas: {passed_checks}/{total_checks}")
+        if skipped_checks:
+            logger.warning(f"   - Verificaciones omitidas por presupuesto: {skipped_checks}")
         
         if quality_score >= 80:
             logger.info("🎉 Calidad de datos EXCELENTE")
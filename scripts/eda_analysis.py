@@ -5,16 +5,22 @@ Analiza el dataset de 5 años para identificar patrones y oportunidades de renta
 """
 
 import os
+import json
+import hashlib
+import tempfile
 import logging
-import pandas as pd
-import numpy as np
+import threading
+import matplotlib
+matplotlib.use('Agg')  # Backend sin interfaz gráfica: solo se generan PNG
 import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-from google.cloud import bigquery
-from datetime import datetime, timedelta
+try:
+    from ._bq import get_client
+except ImportError:  # Ejecutado directamente como script
+    from _bq import get_client
+from google.cloud import bigquery_storage
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from datetime import datetime, timedelta, timezone
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -26,10 +32,49 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = os.getenv('PROJECT_ID') or 'your-project-id'
 DATASET_NAME = 'acero_analysis'
 TABLE_NAME = 'cdo_challenge'
+DAILY_STATS_VIEW = 'mv_daily_stats'  # Creada por load_data.py
+COLUMN_SKETCHES_TABLE = 'col_sketches'  # Creada por load_data.py
+SQL_CACHE_DIR = 'sql_cache'
+# Incrementar al cambiar la plantilla de _build_quality_query para invalidar la caché
+QUALITY_SQL_VERSION = 2
+# Ventana opcional (en días) para limitar los escaneos sobre la tabla base a las particiones recientes
+_window_days = os.getenv('PARTITION_WINDOW_DAYS') or ''
+if _window_days.isdigit() and int(_window_days) > 0:
+    PARTITION_WINDOW_DAYS = int(_window_days)
+else:
+    if _window_days:
+        logger.warning(f"⚠️  PARTITION_WINDOW_DAYS inválido ({_window_days!r}), se analizará el histórico completo")
+    PARTITION_WINDOW_DAYS = None
 
 # Configurar estilo de gráficos
 plt.style.use('seaborn-v0_8')
-sns.set_palette("husl")
+# Paleta "husl" de seaborn (6 colores) fijada directamente para no importar seaborn
+plt.rcParams['axes.prop_cycle'] = plt.cycler(
+    color=['#f77189', '#bb9832', '#50b131', '#36ada4', '#3ba3ec', '#e866f4']
+)
+
+def partition_start_date():
+    """Fecha inicial de la ventana de particiones, o None si no hay ventana"""
+    if PARTITION_WINDOW_DAYS is None:
+        return None
+    
+    # Fecha calculada en el cliente (UTC, como _PARTITIONTIME): la consulta sigue
+    # siendo cacheable durante el día
+    return (datetime.now(timezone.utc) - timedelta(days=PARTITION_WINDOW_DAYS)).strftime('%Y-%m-%d')
+
+def partition_filter():
+    """Predicado sobre _PARTITIONTIME para que BigQuery pode particiones"""
+    start_date = partition_start_date()
+    if start_date is None:
+        return "_PARTITIONTIME IS NOT NULL"
+    return f"_PARTITIONTIME >= TIMESTAMP('{start_date}')"
+
+def date_filter(column):
+    """Mismo predicado de ventana para columnas DATE derivadas de _PARTITIONTIME"""
+    start_date = partition_start_date()
+    if start_date is None:
+        return f"{column} IS NOT NULL"
+    return f"{column} >= DATE('{start_date}')"
 
 class SteelCompanyEDA:
     """Clase para análisis EDA de la empresa de aceros"""
@@ -37,13 +82,22 @@ class SteelCompanyEDA:
     def __init__(self):
         """Inicializar cliente BigQuery"""
         try:
-            self.client = bigquery.Client(project=PROJECT_ID)
+            self.client = get_client(PROJECT_ID)
+            # Storage Read API: resultados en formato Arrow en lugar de páginas JSON por REST
+            self.bqstorage_client = bigquery_storage.BigQueryReadClient()
             self.table_id = f"{PROJECT_ID}.{DATASET_NAME}.{TABLE_NAME}"
+            self.daily_stats_id = f"{PROJECT_ID}.{DATASET_NAME}.{DAILY_STATS_VIEW}"
+            self.column_sketches_id = f"{PROJECT_ID}.{DATASET_NAME}.{COLUMN_SKETCHES_TABLE}"
             logger.info(f"✅ Cliente BigQuery inicializado para tabla: {self.table_id}")
         except Exception as e:
             logger.error(f"❌ Error inicializando BigQuery: {e}")
             raise
     
+    @cached(cache=TTLCache(maxsize=1024, ttl=300), key=lambda self, tid: hashkey(tid), lock=threading.Lock())
+    def _get_table_cached(self, table_id):
+        """Obtener metadatos de la tabla (cacheados 5 minutos)"""
+        return self.client.get_table(table_id)
+    
     def get_data_overview(self):
         """Obtener vista general de los datos"""
         logger.info("🔍 Obteniendo vista general de los datos...")
@@ -56,6 +110,7 @@ class SteelCompanyEDA:
             MAX(DATE(_PARTITIONTIME)) as latest_date,
             COUNT(DISTINCT _FILE_NAME) as source_files
         FROM `{self.table_id}`
+        WHERE {partition_filter()}
         """
         
         try:
@@ -83,7 +138,7 @@ class SteelCompanyEDA:
         logger.info("🏗️  Analizando esquema de la tabla...")
         
         try:
-            table = self.client.get_table(self.table_id)
+            table = self._get_table_cached(self.table_id)
             
             logger.info(f"📋 Esquema de la tabla '{table.table_id}':")
             for field in table.schema:
@@ -99,60 +154,64 @@ class SteelCompanyEDA:
         """Analizar patrones temporales en los datos"""
         logger.info("⏰ Analizando patrones temporales...")
         
+        # Registros por día desde la vista. La serie de archivos por día se retiró:
+        # _FILE_NAME solo existe en tablas externas, no en la tabla nativa cargada
         query = f"""
         SELECT 
-            DATE(_PARTITIONTIME) as date,
-            COUNT(*) as daily_records,
-            COUNT(DISTINCT _FILE_NAME) as daily_files
-        FROM `{self.table_id}`
-        WHERE _PARTITIONTIME IS NOT NULL
-        GROUP BY DATE(_PARTITIONTIME)
+            d as date,
+            n as daily_records
+        FROM `{self.daily_stats_id}`
+        WHERE {date_filter('d')}
         ORDER BY date
         """
         
         try:
             query_job = self.client.query(query)
-            df = query_job.to_dataframe()
-            
-            # Crear gráfico de volumen temporal
-            fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 10))
-            
-            # Gráfico de registros diarios
-            ax1.plot(df['date'], df['daily_records'], linewidth=2, alpha=0.7)
-            ax1.set_title('Volumen de Registros por Día', fontsize=14, fontweight='bold')
-            ax1.set_xlabel('Fecha')
-            ax1.set_ylabel('Número de Registros')
-            ax1.grid(True, alpha=0.3)
-            
-            # Gráfico de archivos diarios
-            ax2.plot(df['date'], df['daily_files'], linewidth=2, alpha=0.7, color='orange')
-            ax2.set_title('Archivos Procesados por Día', fontsize=14, fontweight='bold')
-            ax2.set_xlabel('Fecha')
-            ax2.set_ylabel('Número de Archivos')
-            ax2.grid(True, alpha=0.3)
-            
-            plt.tight_layout()
-            plt.savefig('notebooks/temporal_patterns.png', dpi=300, bbox_inches='tight')
-            plt.close()
-            
-            logger.info("✅ Gráfico de patrones temporales guardado")
-            
-            # Análisis de estacionalidad
-            df['month'] = df['date'].dt.month
-            df['year'] = df['date'].dt.year
+            df = query_job.to_dataframe(bqstorage_client=self.bqstorage_client)
             
-            monthly_avg = df.groupby('month')['daily_records'].mean()
+            # Análisis de estacionalidad: el promedio mensual se agrega en BigQuery (12 filas)
+            monthly_query = f"""
+            SELECT 
+                EXTRACT(MONTH FROM d) as month,
+                AVG(n) as avg_daily_records
+            FROM `{self.daily_stats_id}`
+            WHERE {date_filter('d')}
+            GROUP BY month
+            ORDER BY month
+            """
+            monthly_avg = list(self.client.query(monthly_query).result())
+            month_labels = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 
+                            'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
             
-            fig, ax = plt.subplots(figsize=(12, 6))
-            monthly_avg.plot(kind='bar', ax=ax, color='skyblue', alpha=0.7)
-            ax.set_title('Promedio de Registros por Mes', fontsize=14, fontweight='bold')
-            ax.set_xlabel('Mes')
-            ax.set_ylabel('Promedio de Registros Diarios')
-            ax.set_xticklabels(['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 
-                               'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic'])
-            plt.tight_layout()
-            plt.savefig('notebooks/monthly_patterns.png', dpi=300, bbox_inches='tight')
-            plt.close()
+            # Una sola figura reutilizada para ambos gráficos
+            fig = plt.figure(figsize=(15, 6))
+            try:
+                # Gráfico de registros diarios
+                ax1 = fig.subplots()
+                ax1.plot(df['date'], df['daily_records'], linewidth=2, alpha=0.7)
+                ax1.set_title('Volumen de Registros por Día', fontsize=14, fontweight='bold')
+                ax1.set_xlabel('Fecha')
+                ax1.set_ylabel('Número de Registros')
+                ax1.grid(True, alpha=0.3)
+                
+                fig.tight_layout()
+                fig.savefig('notebooks/temporal_patterns.png', dpi=150, bbox_inches='tight')
+                
+                logger.info("✅ Gráfico de patrones temporales guardado")
+                
+                fig.clf()
+                fig.set_size_inches(12, 6)
+                ax = fig.subplots()
+                ax.bar([month_labels[row.month - 1] for row in monthly_avg],
+                       [row.avg_daily_records for row in monthly_avg],
+                       color='skyblue', alpha=0.7)
+                ax.set_title('Promedio de Registros por Mes', fontsize=14, fontweight='bold')
+                ax.set_xlabel('Mes')
+                ax.set_ylabel('Promedio de Registros Diarios')
+                fig.tight_layout()
+                fig.savefig('notebooks/monthly_patterns.png', dpi=150, bbox_inches='tight')
+            finally:
+                plt.close(fig)
             
             return df
             
@@ -160,48 +219,131 @@ class SteelCompanyEDA:
             logger.error(f"❌ Error analizando patrones temporales: {e}")
             return None
     
+    def get_unique_value_estimates(self):
+        """Estimar valores únicos por columna combinando los sketches HLL++ precalculados"""
+        query = f"""
+        SELECT 
+            col_name,
+            HLL_COUNT.MERGE(sketch) as unique_values
+        FROM `{self.column_sketches_id}`
+        WHERE {date_filter('partition_date')}
+        GROUP BY col_name
+        """
+        
+        try:
+            query_job = self.client.query(query)
+            return {row.col_name: row.unique_values for row in query_job.result()}
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudieron leer los sketches de columnas: {e}")
+            return {}
+    
+    def _build_quality_query(self, table, columns, unique_values):
+        """Generar (o reutilizar) el SQL de calidad para un esquema dado"""
+        # Mismo esquema y versión de plantilla producen el mismo SQL, y BigQuery puede
+        # responder desde su caché de resultados. La plantilla se guarda sin el filtro
+        # de particiones, que cambia cada día y se sustituye al leerla.
+        key = json.dumps({
+            'version': QUALITY_SQL_VERSION,
+            'table': self.table_id,
+            'schema': [(field.name, field.field_type) for field in table.schema],
+            'sketched': sorted(c for c in columns if c in unique_values)
+        })
+        schema_hash = hashlib.sha1(key.encode()).hexdigest()
+        cache_path = os.path.join(SQL_CACHE_DIR, f"quality_{schema_hash}.sql")
+        
+        # Cualquier error de disco se trata como fallo de caché: se usa la plantilla en memoria
+        try:
+            if os.path.exists(cache_path):
+                with open(cache_path, encoding='utf-8') as f:
+                    return f.read().replace('{partition_filter}', partition_filter())
+        except OSError as e:
+            logger.warning(f"⚠️  No se pudo leer la caché de SQL {cache_path}: {e}")
+        
+        # Un solo escaneo: todas las columnas se normalizan a STRING y se despivotan,
+        # así el chequeo de vacíos aplica igual a cualquier tipo. INCLUDE NULLS conserva
+        # los nulos para poder contarlos.
+        casts = ",\n                ".join(f"SAFE_CAST({c} AS STRING) AS {c}" for c in columns)
+        distinct = "" if all(c in unique_values for c in columns) else ",\n            APPROX_COUNT_DISTINCT(v) AS u"
+        template = f"""
+        SELECT 
+            col,
+            COUNT(*) AS total,
+            COUNTIF(v IS NULL) AS n,
+            COUNTIF(v = '') AS e{distinct}
+        FROM (
+            SELECT 
+                {casts}
+            FROM `{self.table_id}`
+            WHERE {{partition_filter}}
+        )
+        UNPIVOT INCLUDE NULLS (v FOR col IN ({', '.join(columns)}))
+        GROUP BY col
+        """
+        
+        # Escritura atómica: un archivo truncado nunca queda disponible en la caché
+        try:
+            os.makedirs(SQL_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=SQL_CACHE_DIR, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(template)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"⚠️  No se pudo guardar la caché de SQL {cache_path}: {e}")
+        
+        return template.replace('{partition_filter}', partition_filter())
+    
     def analyze_data_quality(self):
         """Analizar calidad de los datos"""
         logger.info("🔍 Analizando calidad de los datos...")
         
         # Obtener columnas del esquema
-        table = self.client.get_table(self.table_id)
-        columns = [field.name for field in table.schema]
+        table = self._get_table_cached(self.table_id)
+        columns = [field.name for field in table.schema][:10]  # Analizar primeras 10 columnas
         
-        quality_metrics = {}
+        # Valores únicos desde los sketches; solo se calculan en la consulta los que falten
+        unique_values = self.get_unique_value_estimates()
         
-        for column in columns[:10]:  # Analizar primeras 10 columnas
-            try:
-                query = f"""
-                SELECT 
-                    COUNT(*) as total_rows,
-                    COUNTIF({column} IS NULL) as null_count,
-                    COUNTIF({column} = '') as empty_count,
-                    COUNT(DISTINCT {column}) as unique_values
-                FROM `{self.table_id}`
-                """
-                
-                query_job = self.client.query(query)
-                results = query_job.result()
-                
-                for row in results:
-                    null_percentage = (row.null_count / row.total_rows) * 100 if row.total_rows > 0 else 0
-                    empty_percentage = (row.empty_count / row.total_rows) * 100 if row.total_rows > 0 else 0
-                    
-                    quality_metrics[column] = {
-                        'total_rows': row.total_rows,
-                        'null_count': row.null_count,
-                        'null_percentage': null_percentage,
-                        'empty_count': row.empty_count,
-                        'empty_percentage': empty_percentage,
-                        'unique_values': row.unique_values
-                    }
-                    
-                    logger.info(f"📊 {column}: {null_percentage:.2f}% nulos, {empty_percentage:.2f}% vacíos")
-                    
-            except Exception as e:
-                logger.warning(f"⚠️  No se pudo analizar columna {column}: {e}")
+        query = self._build_quality_query(table, columns, unique_values)
+        
+        try:
+            query_job = self.client.query(query)
+            rows = {row.col: row for row in query_job.result()}
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo analizar calidad de columnas: {e}")
+            return {}
+        
+        if not rows:
+            logger.warning("⚠️  No hay registros en la ventana analizada, se reportan métricas en cero")
+        
+        quality_metrics = {}
+        for column in columns:
+            row = rows.get(column)
+            if row is None:
+                # Sin filas: mismas métricas en cero que reportaba la consulta por columna
+                quality_metrics[column] = {
+                    'total_rows': 0,
+                    'null_count': 0,
+                    'null_percentage': 0,
+                    'empty_count': 0,
+                    'empty_percentage': 0,
+                    'unique_values': unique_values.get(column, 0)
+                }
                 continue
+            
+            quality_metrics[column] = {
+                'total_rows': row.total,
+                'null_count': row.n,
+                'null_percentage': (row.n / row.total) * 100 if row.total > 0 else 0,
+                'empty_count': row.e,
+                'empty_percentage': (row.e / row.total) * 100 if row.total > 0 else 0,
+                'unique_values': unique_values[column] if column in unique_values else row.u
+            }
+            
+            logger.info(f"📊 {column}: {quality_metrics[column]['null_percentage']:.2f}% nulos, {quality_metrics[column]['empty_percentage']:.2f}% vacíos")
         
         return quality_metrics
     
@@ -240,7 +382,6 @@ class SteelCompanyEDA:
             report['data_quality'] = quality
         
         # Guardar reporte
-        import json
         with open('notebooks/eda_summary_report.json', 'w', encoding='utf-8') as f:
             json.dump(report, f, indent=2, default=str, ensure_ascii=False)
         
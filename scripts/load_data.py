@@ -6,11 +6,16 @@ Maneja el archivo de 113.33 GB de manera eficiente
 
 import os
 import logging
+import threading
 from google.cloud import bigquery
+try:
+    from ._bq import get_client
+except ImportError:  # Ejecutado directamente como script
+    from _bq import get_client
 from google.cloud import storage
-import pandas as pd
-from tqdm import tqdm
-import time
+from google.api_core.exceptions import NotFound
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -20,19 +25,98 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = os.getenv('PROJECT_ID') or 'your-project-id'
 DATASET_NAME = 'acero_analysis'
 TABLE_NAME = 'cdo_challenge'
+DAILY_STATS_VIEW = 'mv_daily_stats'
+COLUMN_SKETCHES_TABLE = 'col_sketches'
 SOURCE_URI = 'gs://desafio-deacero-143d30a0-d8f8-4154-b7df-1773cf286d32/cdo_challenge.csv.gz'
+# Esquema explícito de la tabla; se genera a partir de la primera carga con autodetección
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cdo_challenge_schema.json')
+# Bucket propio para la copia en Parquet (el .csv.gz no es divisible y se carga en serie)
+STAGING_BUCKET = os.getenv('STAGING_BUCKET')
+PARQUET_PREFIX = 'parquet/cdo_challenge/'
+PARQUET_URI = f"gs://{STAGING_BUCKET}/{PARQUET_PREFIX}part-*.parquet" if STAGING_BUCKET else None
+# Marcador que se escribe solo cuando la exportación termina completa
+PARQUET_SUCCESS_MARKER = f"{PARQUET_PREFIX}_SUCCESS"
 
 def create_bigquery_client():
     """Crear cliente de BigQuery"""
     try:
-        client = bigquery.Client(project=PROJECT_ID)
+        client = get_client(PROJECT_ID)
         logger.info(f"✅ Cliente BigQuery creado para proyecto: {PROJECT_ID}")
         return client
     except Exception as e:
         logger.error(f"❌ Error creando cliente BigQuery: {e}")
         raise
 
-def create_dataset_and_table(client):
+@cached(cache=TTLCache(maxsize=1024, ttl=300), key=lambda client, tid: hashkey(tid), lock=threading.Lock())
+def get_table_cached(client, table_id):
+    """Obtener metadatos de la tabla (cacheados 5 minutos)"""
+    return client.get_table(table_id)
+
+def parquet_staging_exists():
+    """Verificar si existe una copia completa y vigente en Parquet en el bucket de staging"""
+    try:
+        # Solo el marcador garantiza que no quedan fragmentos de una exportación interrumpida
+        storage_client = storage.Client(project=PROJECT_ID)
+        marker = storage_client.bucket(STAGING_BUCKET).get_blob(PARQUET_SUCCESS_MARKER)
+        if marker is None:
+            return False
+        
+        # Si el CSV de origen cambió después de la exportación, la copia está desactualizada
+        source_bucket, source_name = SOURCE_URI[len('gs://'):].split('/', 1)
+        source = storage_client.bucket(source_bucket).get_blob(source_name)
+        if source is not None and source.updated > marker.updated:
+            logger.info(f"🔄 {SOURCE_URI} es más reciente que la copia en Parquet, se volverá a exportar")
+            return False
+        
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Error verificando staging Parquet en {STAGING_BUCKET}: {e}")
+        return False
+
+def convert_to_parquet(client):
+    """Convertir una única vez el .csv.gz a Parquet fragmentado (Snappy) en GCS"""
+    try:
+        logger.info(f"🔄 Convirtiendo {SOURCE_URI} a Parquet en: {PARQUET_URI}")
+        
+        # Tabla externa temporal sobre el CSV; EXPORT DATA escribe los fragmentos en paralelo
+        external_config = bigquery.ExternalConfig('CSV')
+        external_config.source_uris = [SOURCE_URI]
+        external_config.options.skip_leading_rows = 1
+        external_config.max_bad_records = 1000
+        if os.path.exists(SCHEMA_PATH):
+            external_config.schema = client.schema_from_json(SCHEMA_PATH)
+        else:
+            external_config.autodetect = True
+        
+        job_config = bigquery.QueryJobConfig(table_definitions={'cdo_challenge_csv': external_config})
+        query = f"""
+        EXPORT DATA OPTIONS (
+            uri = '{PARQUET_URI}',
+            format = 'PARQUET',
+            compression = 'SNAPPY',
+            overwrite = true
+        ) AS
+        SELECT * FROM cdo_challenge_csv
+        """
+        
+        # Invalidar el marcador anterior mientras se reescriben los fragmentos
+        storage_client = storage.Client(project=PROJECT_ID)
+        marker = storage_client.bucket(STAGING_BUCKET).blob(PARQUET_SUCCESS_MARKER)
+        if marker.exists():
+            marker.delete()
+        
+        client.query(query, job_config=job_config).result()
+        
+        marker.upload_from_string('')
+        logger.info("✅ Conversión a Parquet completada")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Error convirtiendo a Parquet: {e}")
+        return False
+
+def create_dataset_and_table(client, source_format=bigquery.SourceFormat.CSV):
     """Crear dataset y tabla en BigQuery"""
     try:
         dataset_id = f"{PROJECT_ID}.{DATASET_NAME}"
@@ -41,14 +125,48 @@ def create_dataset_and_table(client):
         dataset = client.create_dataset(dataset, exists_ok=True)
         logger.info(f"✅ Dataset creado: {dataset_id}")
         
-        # Crear tabla con esquema automático
         table_id = f"{dataset_id}.{TABLE_NAME}"
-        job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.CSV,
-            skip_leading_rows=1,  # Saltar encabezados
-            autodetect=True,  # Detección automática de esquema
-            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-            max_bad_records=1000  # Permitir algunos registros malos
+        
+        # WRITE_TRUNCATE no puede cambiar la especificación de particionado de una tabla
+        # existente: una tabla creada por versiones anteriores (sin particionar) se elimina
+        try:
+            existing_table = client.get_table(table_id)
+            if existing_table.time_partitioning is None:
+                logger.warning(f"⚠️  La tabla {table_id} no está particionada, se eliminará para recrearla")
+                client.delete_table(table_id)
+        except NotFound:
+            pass
+        
+        if source_format == bigquery.SourceFormat.PARQUET:
+            # Parquet incluye su propio esquema y BigQuery lo ingiere en paralelo por fragmento
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+            )
+        else:
+            # Crear tabla con esquema explícito (o automático si aún no existe el archivo)
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.CSV,
+                skip_leading_rows=1,  # Saltar encabezados
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                max_bad_records=1000  # Permitir algunos registros malos
+            )
+            
+            # Un esquema declarado evita el muestreo previo del archivo de 113 GB
+            if os.path.exists(SCHEMA_PATH):
+                job_config.autodetect = False
+                job_config.schema = client.schema_from_json(SCHEMA_PATH)
+                logger.info(f"📋 Usando esquema explícito: {SCHEMA_PATH}")
+            else:
+                job_config.autodetect = True  # Detección automática de esquema
+                logger.warning(f"⚠️  No existe {SCHEMA_PATH}, se usará detección automática de esquema")
+        
+        # Particionar por tiempo de ingesta para que los filtros sobre _PARTITIONTIME
+        # descarten particiones completas en lugar de escanear toda la tabla
+        job_config.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field=None,
+            require_partition_filter=False  # El EDA necesita consultar el histórico completo
         )
         
         logger.info(f"✅ Tabla configurada: {table_id}")
@@ -58,24 +176,43 @@ def create_dataset_and_table(client):
         logger.error(f"❌ Error creando dataset/tabla: {e}")
         raise
 
-def load_data_from_gcs(client, table_id, job_config):
+def log_load_progress(load_job, stop_event, interval=30):
+    """Registrar los cambios de estado del job de carga sin bloquear su finalización"""
+    last_state = None
+    while not stop_event.wait(interval):
+        state = load_job.state
+        if state != last_state:
+            logger.info("📈 Estado: %s", state)
+            last_state = state
+
+def load_data_from_gcs(client, table_id, job_config, source_uri=SOURCE_URI):
     """Cargar datos desde Google Cloud Storage a BigQuery"""
     try:
-        logger.info(f"🚀 Iniciando carga de datos desde: {SOURCE_URI}")
+        logger.info(f"🚀 Iniciando carga de datos desde: {source_uri}")
         logger.info("📊 Este proceso puede tomar varias horas debido al tamaño del archivo...")
         
         # Iniciar job de carga
         load_job = client.load_table_from_uri(
-            SOURCE_URI,
+            source_uri,
             table_id,
             job_config=job_config
         )
         
         # Monitorear progreso
         logger.info("⏳ Monitoreando progreso de la carga...")
-        while not load_job.done():
-            time.sleep(30)  # Verificar cada 30 segundos
-            logger.info(f"📈 Estado: {load_job.state}")
+        stop_event = threading.Event()
+        progress_thread = threading.Thread(
+            target=log_load_progress,
+            args=(load_job, stop_event),
+            daemon=True
+        )
+        progress_thread.start()
+        try:
+            # result() hace polling con backoff del SDK y retorna en cuanto termina el job
+            load_job.result(timeout=None)
+        finally:
+            stop_event.set()
+            progress_thread.join()
         
         # Verificar resultado
         if load_job.errors:
@@ -83,7 +220,7 @@ def load_data_from_gcs(client, table_id, job_config):
             return False
         
         # Obtener estadísticas
-        table = client.get_table(table_id)
+        table = get_table_cached(client, table_id)
         logger.info(f"✅ Carga completada exitosamente!")
         logger.info(f"📊 Registros cargados: {table.num_rows:,}")
         logger.info(f"🗂️  Tamaño de tabla: {table.num_bytes / (1024**3):.2f} GB")
@@ -94,6 +231,75 @@ def load_data_from_gcs(client, table_id, job_config):
         logger.error(f"❌ Error en la carga de datos: {e}")
         return False
 
+def create_daily_stats_view(client, table_id):
+    """Crear vista materializada con estadísticas diarias de la tabla cargada"""
+    try:
+        view_id = f"{PROJECT_ID}.{DATASET_NAME}.{DAILY_STATS_VIEW}"
+        logger.info(f"🧮 Creando vista materializada: {view_id}")
+        
+        # BigQuery la refresca de forma incremental cuando cambia la tabla base,
+        # por lo que las verificaciones diarias escanean MB en lugar de la tabla completa.
+        # Solo usa _PARTITIONTIME: _FILE_NAME y _FILE_LOAD_TIME no existen en tablas nativas.
+        query = f"""
+        CREATE OR REPLACE MATERIALIZED VIEW `{view_id}` AS
+        SELECT 
+            DATE(_PARTITIONTIME) as d,
+            COUNT(*) as n,
+            MAX(_PARTITIONTIME) as latest
+        FROM `{table_id}`
+        GROUP BY d
+        """
+        
+        client.query(query).result()
+        logger.info("✅ Vista materializada de estadísticas diarias lista")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Error creando vista materializada: {e}")
+        return False
+
+def create_column_sketches(client, table_id):
+    """Precalcular sketches HLL++ por columna y partición para estimar valores únicos"""
+    try:
+        sketches_id = f"{PROJECT_ID}.{DATASET_NAME}.{COLUMN_SKETCHES_TABLE}"
+        logger.info(f"🧮 Creando tabla de sketches: {sketches_id}")
+        
+        # Un sketch por columna y día: el EDA los combina con HLL_COUNT.MERGE
+        # sin volver a escanear la tabla base. HLL_COUNT.INIT no acepta todos
+        # los tipos, por lo que cada columna se normaliza a STRING.
+        table = get_table_cached(client, table_id)
+        sketches = "\n        UNION ALL\n".join(
+            f"""        SELECT '{field.name}' as col_name, DATE(_PARTITIONTIME) as partition_date,
+            HLL_COUNT.INIT(SAFE_CAST({field.name} AS STRING)) as sketch
+        FROM `{table_id}`
+        GROUP BY partition_date"""
+            for field in table.schema
+        )
+        query = f"""
+        CREATE OR REPLACE TABLE `{sketches_id}` AS
+{sketches}
+        """
+        
+        client.query(query).result()
+        logger.info("✅ Tabla de sketches lista")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Error creando tabla de sketches: {e}")
+        return False
+
+def save_table_schema(client, table_id):
+    """Guardar el esquema de la tabla cargada para las siguientes cargas"""
+    try:
+        table = get_table_cached(client, table_id)
+        client.schema_to_json(table.schema, SCHEMA_PATH)
+        logger.info(f"✅ Esquema guardado en: {SCHEMA_PATH}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Error guardando esquema: {e}")
+        return False
+
 def validate_data_quality(client, table_id):
     """Validar calidad de los datos cargados"""
     try:
@@ -118,7 +324,7 @@ def validate_data_quality(client, table_id):
             logger.info(f"⏰ Rango de carga: {row.earliest_load} a {row.latest_load}")
         
         # Verificar columnas
-        table = client.get_table(table_id)
+        table = get_table_cached(client, table_id)
         logger.info(f"🏗️  Esquema de tabla:")
         for field in table.schema:
             logger.info(f"   - {field.name}: {field.field_type}")
@@ -137,13 +343,35 @@ def main():
         # Crear cliente
         client = create_bigquery_client()
         
+        # Preparar copia en Parquet si hay bucket de staging configurado
+        use_parquet = False
+        if STAGING_BUCKET:
+            use_parquet = parquet_staging_exists() or convert_to_parquet(client)
+        else:
+            logger.info("ℹ️  STAGING_BUCKET no configurado, se cargará directamente el .csv.gz")
+        
         # Crear dataset y tabla
-        table_id, job_config = create_dataset_and_table(client)
+        if use_parquet:
+            table_id, job_config = create_dataset_and_table(client, bigquery.SourceFormat.PARQUET)
+            source_uri = PARQUET_URI
+        else:
+            table_id, job_config = create_dataset_and_table(client)
+            source_uri = SOURCE_URI
         
         # Cargar datos
-        success = load_data_from_gcs(client, table_id, job_config)
+        success = load_data_from_gcs(client, table_id, job_config, source_uri)
         
         if success:
+            # Persistir el esquema detectado para no volver a muestrear el archivo
+            if job_config.autodetect:
+                save_table_schema(client, table_id)
+            
+            # Vista materializada para las verificaciones diarias
+            create_daily_stats_view(client, table_id)
+            
+            # Sketches de cardinalidad para el EDA
+            create_column_sketches(client, table_id)
+            
             # Validar calidad
             validate_data_quality(client, table_id)
             logger.info("🎉 Proceso de carga completado exitosamente!")